@@ -21,28 +21,82 @@ class BERTEncoder(nn.Module):
         logger.info(f"Loading Encoder @ {config_name_or_path}")
         self.tokenizer = AutoTokenizer.from_pretrained(config_name_or_path)
         self.bert = AutoModel.from_pretrained(config_name_or_path)
+        # Sentences are re-sampled into many episodes: cache their tokenization once and for all
+        self._tokenization_cache = dict()
+        # Pinned staging buffers, grown on demand and refilled in place each forward
+        self._input_ids_buf = None
+        self._attention_mask_buf = None
+        self._token_type_ids_buf = None
+        # Marks the previous forward's host->device copies out of the staging buffers
+        self._copy_event = None
         logger.info(f"Encoder loaded.")
 
+    def encode_sentence(self, sentence: str):
+        encoded = self._tokenization_cache.get(sentence)
+        if encoded is None:
+            e = self.tokenizer.encode_plus(sentence, max_length=128)
+            encoded = {
+                "input_ids": torch.tensor(e["input_ids"], dtype=torch.long),
+                "token_type_ids": torch.tensor(e["token_type_ids"], dtype=torch.long)
+            }
+            self._tokenization_cache[sentence] = encoded
+        return encoded
+
+    def _get_buffers(self, n_sentences, max_len):
+        if (self._input_ids_buf is None
+                or self._input_ids_buf.size(0) < n_sentences
+                or self._input_ids_buf.size(1) < max_len):
+            # Grow, never shrink: keep the capacity acquired for earlier shapes so
+            # alternating episode shapes do not reallocate on every call
+            if self._input_ids_buf is not None:
+                n_sentences = max(n_sentences, self._input_ids_buf.size(0))
+                max_len = max(max_len, self._input_ids_buf.size(1))
+            pin = torch.cuda.is_available()
+            self._input_ids_buf = torch.zeros(n_sentences, max_len, dtype=torch.long, pin_memory=pin)
+            self._attention_mask_buf = torch.zeros(n_sentences, max_len, dtype=torch.long, pin_memory=pin)
+            self._token_type_ids_buf = torch.zeros(n_sentences, max_len, dtype=torch.long, pin_memory=pin)
+        return self._input_ids_buf, self._attention_mask_buf, self._token_type_ids_buf
+
     def forward(self, sentences: List[str]):
+        encoded_plus = [self.encode_sentence(s) for s in sentences]
+        max_len = max([e["input_ids"].size(0) for e in encoded_plus])
+        n_sentences = len(sentences)
+
+        # Fill the staging buffers in place: no per-sentence list concat, one host->device copy
+        input_ids_buf, attention_mask_buf, token_type_ids_buf = self._get_buffers(n_sentences, max_len)
+        if self._copy_event is not None:
+            # The previous forward's non-blocking copies read these buffers: wait for
+            # them before overwriting, or a backlogged GPU sees corrupted token ids
+            self._copy_event.synchronize()
+        input_ids_buf[:n_sentences, :max_len].fill_(self.tokenizer.pad_token_id)
+        attention_mask_buf[:n_sentences, :max_len].zero_()
+        token_type_ids_buf[:n_sentences, :max_len].zero_()
+        for i, e in enumerate(encoded_plus):
+            length = e["input_ids"].size(0)
+            input_ids_buf[i, :length].copy_(e["input_ids"])
+            attention_mask_buf[i, :length].fill_(1)
+            token_type_ids_buf[i, :length].copy_(e["token_type_ids"])
+
+        input_ids = input_ids_buf[:n_sentences, :max_len].to(device, non_blocking=True)
+        attention_mask = attention_mask_buf[:n_sentences, :max_len].to(device, non_blocking=True)
+        token_type_ids = token_type_ids_buf[:n_sentences, :max_len].to(device, non_blocking=True)
+        if torch.cuda.is_available():
+            if self._copy_event is None:
+                self._copy_event = torch.cuda.Event()
+            self._copy_event.record()
+
+        return self.forward_tokenized(input_ids, attention_mask, token_type_ids)
+
+    def forward_tokenized(self, input_ids, attention_mask, token_type_ids):
         batch_size = 16
-        if len(sentences) > batch_size:
-            return torch.cat([self.forward(sentences[i:i + batch_size]) for i in range(0, len(sentences), batch_size)], 0)
-        encoded_plus = [self.tokenizer.encode_plus(s, max_length=128) for s in sentences]
-        max_len = max([len(e['input_ids']) for e in encoded_plus])
-
-        input_ids = list()
-        attention_masks = list()
-        token_type_ids = list()
-
-        for e in encoded_plus:
-            e['input_ids'] = e['input_ids'][:max_len]
-            e['token_type_ids'] = e['token_type_ids'][:max_len]
-            pad_len = max_len - len(e['input_ids'])
-            input_ids.append(e['input_ids'] + pad_len * [self.tokenizer.pad_token_id])
-            attention_masks.append([1 for _ in e['input_ids']] + [0] * pad_len)
-            token_type_ids.append(e['token_type_ids'] + [0] * pad_len)
-
-        _, x = self.bert.forward(input_ids=torch.Tensor(input_ids).long().to(device),
-                                 attention_mask=torch.Tensor(attention_masks).long().to(device),
-                                 token_type_ids=torch.Tensor(token_type_ids).long().to(device))
-        return x
+        input_ids = input_ids.to(device, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+        token_type_ids = token_type_ids.to(device, non_blocking=True)
+
+        outputs = list()
+        for i in range(0, input_ids.size(0), batch_size):
+            _, x = self.bert.forward(input_ids=input_ids[i:i + batch_size],
+                                     attention_mask=attention_mask[i:i + batch_size],
+                                     token_type_ids=token_type_ids[i:i + batch_size])
+            outputs.append(x)
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs, 0)
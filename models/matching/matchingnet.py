@@ -2,19 +2,21 @@ import json
 import argparse
 from utils.data import get_jsonl_data
 from utils.python import now, set_seeds
-import random
 import collections
+import contextlib
+import copy
 import os
-from typing import List, Dict
+from typing import List
 from tensorboardX import SummaryWriter
 import numpy as np
 from models.encoders.bert_encoder import BERTEncoder
 import torch
 import torch.nn as nn
+import torch.nn.functional as torch_functional
 import warnings
 import logging
-from utils.few_shot import create_episode, create_ARSC_train_episode, create_ARSC_test_episode
-from utils.math import euclidean_dist, cosine_similarity
+from utils.few_shot import create_episode, create_episode_loader, create_ARSC_train_episode, create_ARSC_test_episode
+from utils.math import matmul_cdist
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -24,6 +26,15 @@ warnings.simplefilter('ignore')
 
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
+# Mixed precision needs torch>=1.6; fall back to full precision on older installs
+amp_enabled = torch.cuda.is_available() and hasattr(torch.cuda, "amp") and hasattr(torch.cuda.amp, "autocast")
+
+
+def autocast_if_available():
+    if amp_enabled:
+        return torch.cuda.amp.autocast()
+    return contextlib.suppress()
+
 
 class MatchingNet(nn.Module):
     def __init__(self, encoder, metric: str = "cosine"):
@@ -32,8 +43,61 @@ class MatchingNet(nn.Module):
         self.encoder = encoder
         self.metric = metric
         assert self.metric in ("cosine", "euclidean")
+        self.loss_fn = nn.CrossEntropyLoss()
+        self.scaler = torch.cuda.amp.GradScaler() if amp_enabled else None
+        # Sentence -> embedding cache, only valid within one evaluation (weights change in between)
+        self._eval_emb_cache = dict()
+
+        # torch.compile (torch>=2.0) fuses the norm/addmm/mean/CE tail into fewer kernels
+        # and caches a graph for the fixed episode shape
+        self._forward = self.forward
+        self._compiled = False
+        if hasattr(torch, "compile") and torch.cuda.is_available():
+            self._forward = torch.compile(self.forward, mode="reduce-overhead", dynamic=False)
+            self._compiled = True
+        # Traced specializations of forward keyed by episode shape, used when compile is unavailable
+        self._traced_forwards = dict()
+
+    def forward(self, z, n_class, n_support, n_query, targets):
+        z_support = z[:n_class * n_support]
+        z_query = z[n_class * n_support:]
+
+        if self.metric == "euclidean":
+            if z_query.is_cuda:
+                similarities = -matmul_cdist(z_query, z_support)
+            else:
+                similarities = -torch.cdist(z_query, z_support)
+        elif self.metric == "cosine":
+            # Cosine is the dot product of unit vectors: normalize + one GEMM, scaled in place
+            z_query_unit = torch_functional.normalize(z_query, dim=1)
+            z_support_unit = torch_functional.normalize(z_support, dim=1)
+            similarities = (z_query_unit @ z_support_unit.t()).mul_(5)
+        else:
+            raise NotImplementedError
 
-    def loss(self, sample):
+        # Average over support samples
+        distances_from_query_to_classes = similarities.view(n_class * n_query, n_class, n_support).mean(dim=2)
+        loss_val = self.loss_fn(distances_from_query_to_classes, targets)
+        acc_val = (targets == distances_from_query_to_classes.argmax(1)).float().mean()
+
+        return distances_from_query_to_classes, loss_val, acc_val
+
+    def _specialized_forward(self, z, n_class, n_support, n_query, targets):
+        if self._compiled:
+            return self._forward(z, n_class, n_support, n_query, targets)
+        # Episode shapes are CLI constants: trace the tail once per shape so later
+        # episodes skip Python dispatch on this hot path
+        key = (n_class, n_support, n_query, z.dtype)
+        traced = self._traced_forwards.get(key)
+        if traced is None:
+            def tail(z_, targets_):
+                return self.forward(z_, n_class, n_support, n_query, targets_)
+
+            traced = torch.jit.trace(tail, (z, targets), check_trace=False)
+            self._traced_forwards[key] = traced
+        return traced(z, targets)
+
+    def loss(self, sample, return_y_hat=False):
         """
         :param sample: {
             "xs": [
@@ -48,86 +112,112 @@ class MatchingNet(nn.Module):
                 [query_C_1, query_C_2, ...],
                 ...
             ]
-        } 
-        :return: 
+        }
+        or a pre-tokenized episode from the prefetching loader, with
+        "input_ids"/"attention_mask"/"token_type_ids" tensors and
+        "n_class"/"n_support"/"n_query" ints.
+        :return:
         """
-        xs = sample["xs"]  # support
-        xq = sample["xq"]  # query
-
-        n_class = len(xs)
-        assert len(xq) == n_class
-        n_support = len(xs[0])
-        n_query = len(xq[0])
-
-        x = [item for xs_ in xs for item in xs_] + [item for xq_ in xq for item in xq_]
-        z = self.encoder.forward(x)
-        z_support = z[:n_class * n_support]
-        z_query = z[n_class * n_support:]
-
-        if self.metric == "euclidean":
-            similarities = -euclidean_dist(z_query, z_support)
-        elif self.metric == "cosine":
-            similarities = cosine_similarity(z_query, z_support) * 5
+        if "input_ids" in sample:
+            # Pre-tokenized episode: feed tensors straight to the transformer, no string round-trip
+            n_class = sample["n_class"]
+            n_support = sample["n_support"]
+            n_query = sample["n_query"]
+            z = self.encoder.forward_tokenized(sample["input_ids"], sample["attention_mask"], sample["token_type_ids"])
         else:
-            raise NotImplementedError
-
-        # Average over support samples
-        distances_from_query_to_classes = torch.cat([similarities[:, c * n_support: (c + 1) * n_support].mean(1).view(1, -1) for c in range(n_class)]).T
-        true_labels = torch.zeros_like(distances_from_query_to_classes)
-
-        for ix_class, class_query_sentences in enumerate(xq):
-            for ix_sentence, sentence in enumerate(class_query_sentences):
-                true_labels[ix_class * n_query + ix_sentence, ix_class] = 1
-
-        loss_fn = nn.CrossEntropyLoss()
-        loss_val = loss_fn(distances_from_query_to_classes, true_labels.argmax(1))
-        acc_val = (true_labels.argmax(1) == distances_from_query_to_classes.argmax(1)).float().mean()
-
-        return loss_val, {
-            "loss": loss_val.item(),
-            "acc": acc_val.item(),
-            "y_hat": distances_from_query_to_classes.argmax(1).cpu().detach().numpy()
+            xs = sample["xs"]  # support
+            xq = sample["xq"]  # query
+
+            n_class = len(xs)
+            assert len(xq) == n_class
+            n_support = len(xs[0])
+            n_query = len(xq[0])
+
+            x = [item for xs_ in xs for item in xs_] + [item for xq_ in xq for item in xq_]
+            if self.training:
+                z = self.encoder.forward(x)
+            else:
+                z = self.encode_cached(x)
+
+        targets = torch.arange(n_class, device=z.device).repeat_interleave(n_query)
+        distances_from_query_to_classes, loss_val, acc_val = self._specialized_forward(z, n_class, n_support, n_query, targets)
+
+        # Scalars are kept on device; callers sync them in one batch when needed
+        loss_dict = {
+            "loss": loss_val.detach(),
+            "acc": acc_val.detach()
         }
-
-    def train_step(self, optimizer, data_dict: Dict[str, List[str]], n_support, n_classes, n_query):
-
-        episode = create_episode(
-            data_dict=data_dict,
-            n_support=n_support,
-            n_classes=n_classes,
-            n_query=n_query
-        )
-
+        if return_y_hat:
+            loss_dict["y_hat"] = distances_from_query_to_classes.argmax(1).cpu().detach().numpy()
+
+        return loss_val, loss_dict
+
+    def encode_cached(self, sentences: List[str]):
+        # During evaluation the same sentences recur across episodes: only encode cache misses
+        missing = list(dict.fromkeys([s for s in sentences if s not in self._eval_emb_cache]))
+        if missing:
+            z_missing = self.encoder.forward(missing)
+            # clone: rows of a compiled (CUDA-graph) encoder output alias the graph's
+            # static buffers and would be overwritten by the next replay
+            for sentence, embedding in zip(missing, z_missing):
+                self._eval_emb_cache[sentence] = embedding.detach().clone()
+        return torch.stack([self._eval_emb_cache[s] for s in sentences])
+
+    def _make_eval_encoder(self):
+        # Fresh reduced-precision copy each evaluation: weights change between evals,
+        # and casting the training encoder in place would round its fp32 weights
+        try:
+            eval_encoder = copy.deepcopy(self.encoder)
+        except Exception:
+            logger.warning("Could not copy the encoder for reduced-precision eval, evaluating in full precision.")
+            return self.encoder
+        if device.type == "cuda":
+            return eval_encoder.half()
+        return torch.quantization.quantize_dynamic(eval_encoder, {nn.Linear}, dtype=torch.qint8)
+
+    def train_step(self, optimizer, episode):
         self.train()
         optimizer.zero_grad()
-        torch.cuda.empty_cache()
-        loss, loss_dict = self.loss(episode)
-        loss.backward()
-        optimizer.step()
+        with autocast_if_available():
+            loss, loss_dict = self.loss(episode)
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         return loss, loss_dict
 
     def test_step(self, data_dict, n_support, n_classes, n_query, n_episodes=1000):
-        accuracies = list()
-        losses = list()
+        loss_sum = 0.0
+        acc_sum = 0.0
         self.eval()
-        for i in range(n_episodes):
-            episode = create_episode(
-                data_dict=data_dict,
-                n_support=n_support,
-                n_classes=n_classes,
-                n_query=n_query
-            )
-
-            with torch.no_grad():
-                loss, loss_dict = self.loss(episode)
-
-            accuracies.append(loss_dict["acc"])
-            losses.append(loss_dict["loss"])
-
+        self._eval_emb_cache.clear()
+        train_encoder = self.encoder
+        self.encoder = self._make_eval_encoder()
+        try:
+            for i in range(n_episodes):
+                episode = create_episode(
+                    data_dict=data_dict,
+                    n_support=n_support,
+                    n_classes=n_classes,
+                    n_query=n_query
+                )
+
+                with torch.no_grad(), autocast_if_available():
+                    loss, loss_dict = self.loss(episode)
+
+                loss_sum += loss_dict["loss"]
+                acc_sum += loss_dict["acc"]
+        finally:
+            self.encoder = train_encoder
+
+        # Single device->host sync for the whole evaluation
         return {
-            "loss": np.mean(losses),
-            "acc": np.mean(accuracies)
+            "loss": (loss_sum / n_episodes).item(),
+            "acc": (acc_sum / n_episodes).item()
         }
 
     def train_step_ARSC(self, data_path: str, optimizer):
@@ -135,30 +225,42 @@ class MatchingNet(nn.Module):
 
         self.train()
         optimizer.zero_grad()
-        torch.cuda.empty_cache()
-        loss, loss_dict = self.loss(episode)
-        loss.backward()
-        optimizer.step()
+        with autocast_if_available():
+            loss, loss_dict = self.loss(episode)
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         return loss, loss_dict
 
     def test_step_ARSC(self, data_path: str, n_episodes=1000, set_type="test"):
         assert set_type in ("dev", "test")
-        accuracies = list()
-        losses = list()
+        loss_sum = 0.0
+        acc_sum = 0.0
         self.eval()
-        for i in range(n_episodes):
-            episode = create_ARSC_test_episode(prefix=data_path, n_query=5, set_type=set_type)
-
-            with torch.no_grad():
-                loss, loss_dict = self.loss(episode)
-
-            accuracies.append(loss_dict["acc"])
-            losses.append(loss_dict["loss"])
-
+        self._eval_emb_cache.clear()
+        train_encoder = self.encoder
+        self.encoder = self._make_eval_encoder()
+        try:
+            for i in range(n_episodes):
+                episode = create_ARSC_test_episode(prefix=data_path, n_query=5, set_type=set_type)
+
+                with torch.no_grad(), autocast_if_available():
+                    loss, loss_dict = self.loss(episode)
+
+                loss_sum += loss_dict["loss"]
+                acc_sum += loss_dict["acc"]
+        finally:
+            self.encoder = train_encoder
+
+        # Single device->host sync for the whole evaluation
         return {
-            "loss": np.mean(losses),
-            "acc": np.mean(accuracies)
+            "loss": (loss_sum / n_episodes).item(),
+            "acc": (acc_sum / n_episodes).item()
         }
 
 
@@ -178,7 +280,8 @@ def run_matching(
         log_every: int = 10,
         metric: str = "cosine",
         arsc_format: bool = False,
-        data_path: str = None
+        data_path: str = None,
+        gradient_checkpointing: bool = False
 ):
     if output_path:
         if os.path.exists(output_path) and len(os.listdir(output_path)):
@@ -189,51 +292,63 @@ def run_matching(
     # --------------------
     os.makedirs(output_path)
     os.makedirs(os.path.join(output_path, "logs/train"))
-    train_writer: SummaryWriter = SummaryWriter(logdir=os.path.join(output_path, "logs/train"), flush_secs=1, max_queue=1)
+    train_writer: SummaryWriter = SummaryWriter(logdir=os.path.join(output_path, "logs/train"), flush_secs=30, max_queue=1000)
     valid_writer: SummaryWriter = None
     test_writer: SummaryWriter = None
     log_dict = dict(train=list())
 
     if valid_path:
         os.makedirs(os.path.join(output_path, "logs/valid"))
-        valid_writer = SummaryWriter(logdir=os.path.join(output_path, "logs/valid"), flush_secs=1, max_queue=1)
+        valid_writer = SummaryWriter(logdir=os.path.join(output_path, "logs/valid"), flush_secs=30, max_queue=1000)
         log_dict["valid"] = list()
     if test_path:
         os.makedirs(os.path.join(output_path, "logs/test"))
-        test_writer = SummaryWriter(logdir=os.path.join(output_path, "logs/test"), flush_secs=1, max_queue=1)
+        test_writer = SummaryWriter(logdir=os.path.join(output_path, "logs/test"), flush_secs=30, max_queue=1000)
         log_dict["test"] = list()
 
-    def raw_data_to_labels_dict(data, shuffle=True):
+    def raw_data_to_labels_dict(data):
         labels_dict = collections.defaultdict(list)
         for item in data:
             labels_dict[item["label"]].append(item["sentence"])
-        labels_dict = dict(labels_dict)
-        if shuffle:
-            for key, val in labels_dict.items():
-                random.shuffle(val)
-        return labels_dict
+        # numpy object arrays so create_episode samples by index instead of shuffling lists
+        return {label: np.asarray(sentences, dtype=object) for label, sentences in labels_dict.items()}
 
     # Load model
     bert = BERTEncoder(model_name_or_path).to(device)
+    if gradient_checkpointing:
+        # Re-compute BERT activations during backward: ~O(layers) less activation memory,
+        # which makes room for larger episodes or AMP
+        if hasattr(bert.bert, "gradient_checkpointing_enable"):
+            bert.bert.gradient_checkpointing_enable()
+        elif hasattr(bert.bert.config, "gradient_checkpointing"):
+            bert.bert.config.gradient_checkpointing = True
+        else:
+            logger.warning("Installed transformers does not support gradient checkpointing, ignoring.")
+    # reduce-overhead captures the fixed-shape transformer step as a CUDA graph and
+    # replays it, removing per-kernel launch latency; it needs the static episode
+    # shapes guaranteed by static_length padding in the episode loader below
+    use_cuda_graphs = hasattr(torch, "compile") and torch.cuda.is_available()
+    if use_cuda_graphs:
+        bert.bert = torch.compile(bert.bert, mode="reduce-overhead")
     matching_net = MatchingNet(encoder=bert, metric=metric)
     optimizer = torch.optim.Adam(matching_net.parameters(), lr=2e-5)
 
     # Load data
     if not arsc_format:
         train_data = get_jsonl_data(train_path)
-        train_data_dict = raw_data_to_labels_dict(train_data, shuffle=True)
+        train_data_dict = raw_data_to_labels_dict(train_data)
         logger.info(f"train labels: {train_data_dict.keys()}")
 
         if valid_path:
             valid_data = get_jsonl_data(valid_path)
-            valid_data_dict = raw_data_to_labels_dict(valid_data, shuffle=True)
+            valid_data_dict = raw_data_to_labels_dict(valid_data)
             logger.info(f"valid labels: {valid_data_dict.keys()}")
         else:
             valid_data_dict = None
 
         if test_path:
             test_data = get_jsonl_data(test_path)
-            test_data_dict = raw_data_to_labels_dict(test_data, shuffle=True)
+            test_data_dict = raw_data_to_labels_dict(test_data)
             logger.info(f"test labels: {test_data_dict.keys()}")
         else:
             test_data_dict = None
@@ -242,8 +357,22 @@ def run_matching(
         valid_data_dict = None
         test_data_dict = None
 
-    train_accuracies = list()
-    train_losses = list()
+    # Sample training episodes in a background worker so sampling overlaps GPU compute
+    if not arsc_format:
+        train_episodes = iter(create_episode_loader(
+            data_dict=train_data_dict,
+            n_support=n_support,
+            n_classes=n_classes,
+            n_query=n_query,
+            tokenizer=bert.tokenizer,
+            static_length=use_cuda_graphs
+        ))
+    else:
+        train_episodes = None
+
+    train_loss_sum = 0.0
+    train_acc_sum = 0.0
+    train_count = 0
     n_eval_since_last_best = 0
     best_valid_acc = 0.0
 
@@ -251,41 +380,42 @@ def run_matching(
         if not arsc_format:
             loss, loss_dict = matching_net.train_step(
                 optimizer=optimizer,
-                data_dict=train_data_dict,
-                n_support=n_support,
-                n_query=n_query,
-                n_classes=n_classes
+                episode=next(train_episodes)
             )
         else:
             loss, loss_dict = matching_net.train_step_ARSC(
                 data_path=data_path,
                 optimizer=optimizer
             )
-        train_accuracies.append(loss_dict["acc"])
-        train_losses.append(loss_dict["loss"])
+        train_loss_sum += loss_dict["loss"]
+        train_acc_sum += loss_dict["acc"]
+        train_count += 1
 
         # Logging
         if (step + 1) % log_every == 0:
-            train_writer.add_scalar(tag="loss", scalar_value=np.mean(train_losses), global_step=step)
-            train_writer.add_scalar(tag="accuracy", scalar_value=np.mean(train_accuracies), global_step=step)
-            logger.info(f"train | loss: {np.mean(train_losses):.4f} | acc: {np.mean(train_accuracies):.4f}")
+            train_loss = (train_loss_sum / train_count).item()
+            train_acc = (train_acc_sum / train_count).item()
+            train_writer.add_scalar(tag="loss", scalar_value=train_loss, global_step=step)
+            train_writer.add_scalar(tag="accuracy", scalar_value=train_acc, global_step=step)
+            logger.info(f"train | loss: {train_loss:.4f} | acc: {train_acc:.4f}")
             log_dict["train"].append({
                 "metrics": [
                     {
                         "tag": "accuracy",
-                        "value": np.mean(train_accuracies)
+                        "value": train_acc
                     },
                     {
                         "tag": "loss",
-                        "value": np.mean(train_losses)
+                        "value": train_loss
                     }
 
                 ],
                 "global_step": step
             })
 
-            train_accuracies = list()
-            train_losses = list()
+            train_loss_sum = 0.0
+            train_acc_sum = 0.0
+            train_count = 0
 
         if valid_path or test_path:
             if (step + 1) % evaluate_every == 0:
@@ -371,6 +501,9 @@ def main():
 
     # ARSC data
     parser.add_argument("--arsc-format", default=False, action="store_true", help="Using ARSC few-shot format")
+
+    # Memory
+    parser.add_argument("--gradient-checkpointing", default=False, action="store_true", help="Trade compute for BERT activation memory")
     args = parser.parse_args()
 
     # Set random seed
@@ -401,7 +534,8 @@ def main():
         early_stop=args.early_stop,
         arsc_format=args.arsc_format,
         data_path=args.data_path,
-        log_every=args.log_every
+        log_every=args.log_every,
+        gradient_checkpointing=args.gradient_checkpointing
     )
 
     # Save config
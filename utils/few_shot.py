@@ -27,25 +27,130 @@ def create_episode(data_dict, n_support, n_classes, n_query, n_unlabeled=0):
 
     assert min([len(val) for val in data_dict.values()]) >= n_support + n_query + n_unlabeled
 
-    for key, val in data_dict.items():
-        random.shuffle(val)
-
-    episode = {
-        "xs": [
-            [data_dict[k][i] for i in range(n_support)] for k in rand_keys
-        ],
-        "xq": [
-            [data_dict[k][n_support + i] for i in range(n_query)] for k in rand_keys
-        ]
-    }
-
+    episode = {"xs": list(), "xq": list()}
     if n_unlabeled:
-        episode['xu'] = [
-            item for k in rand_keys for item in data_dict[k][n_support + n_query:n_support + n_query + 10]
-        ]
+        episode["xu"] = list()
+
+    for key in rand_keys:
+        data = data_dict[key]
+        if not isinstance(data, np.ndarray):
+            data = np.asarray(data, dtype=object)
+        # Vectorized index sampling instead of shuffling every class list on every episode
+        indices = np.random.choice(len(data), n_support + n_query + n_unlabeled, replace=False)
+        episode["xs"].append(list(data[indices[:n_support]]))
+        episode["xq"].append(list(data[indices[n_support:n_support + n_query]]))
+        if n_unlabeled:
+            episode["xu"].extend(data[indices[n_support + n_query:]])
+
     return episode
 
 
+class EpisodeDataset(torch.utils.data.IterableDataset):
+    """
+    Infinite stream of episodes, meant to be consumed through a DataLoader so that
+    a worker samples episode k+1 while the GPU is busy with episode k.
+
+    When a tokenizer is given, episodes are yielded pre-tokenized as padded
+    input_ids/attention_mask/token_type_ids tensors instead of nested string lists.
+    """
+
+    def __init__(self, data_dict, n_support, n_classes, n_query, n_unlabeled=0, tokenizer=None, max_length=128,
+                 static_length=False):
+        super(EpisodeDataset, self).__init__()
+        self.data_dict = data_dict
+        self.n_support = n_support
+        self.n_classes = n_classes
+        self.n_query = n_query
+        self.n_unlabeled = n_unlabeled
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        # Always pad to max_length so every episode has identical tensor shapes,
+        # as required for CUDA graph capture/replay of the training step
+        self.static_length = static_length
+        self._tokenization_cache = dict()
+
+    def _encode_sentence(self, sentence):
+        encoded = self._tokenization_cache.get(sentence)
+        if encoded is None:
+            e = self.tokenizer.encode_plus(sentence, max_length=self.max_length)
+            encoded = {
+                "input_ids": torch.tensor(e["input_ids"], dtype=torch.long),
+                "token_type_ids": torch.tensor(e["token_type_ids"], dtype=torch.long)
+            }
+            self._tokenization_cache[sentence] = encoded
+        return encoded
+
+    def _tokenize_episode(self, episode):
+        sentences = [item for xs_ in episode["xs"] for item in xs_] + [item for xq_ in episode["xq"] for item in xq_]
+        encoded_plus = [self._encode_sentence(s) for s in sentences]
+        if self.static_length:
+            max_len = self.max_length
+        else:
+            max_len = max([e["input_ids"].size(0) for e in encoded_plus])
+
+        input_ids = torch.full((len(sentences), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(len(sentences), max_len, dtype=torch.long)
+        token_type_ids = torch.zeros(len(sentences), max_len, dtype=torch.long)
+        for i, e in enumerate(encoded_plus):
+            length = e["input_ids"].size(0)
+            input_ids[i, :length] = e["input_ids"]
+            attention_mask[i, :length] = 1
+            token_type_ids[i, :length] = e["token_type_ids"]
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+            "n_class": len(episode["xs"]),
+            "n_support": len(episode["xs"][0]),
+            "n_query": len(episode["xq"][0])
+        }
+
+    def __iter__(self):
+        while True:
+            episode = create_episode(
+                data_dict=self.data_dict,
+                n_support=self.n_support,
+                n_classes=self.n_classes,
+                n_query=self.n_query,
+                n_unlabeled=self.n_unlabeled
+            )
+            yield self._tokenize_episode(episode) if self.tokenizer is not None else episode
+
+
+def episode_worker_init_fn(worker_id):
+    # Workers fork the parent's RNG state: re-seed so they do not all sample the same episodes
+    seed = (torch.initial_seed() + worker_id) % (2 ** 32)
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def first_item_collate(batch):
+    return batch[0]
+
+
+def create_episode_loader(data_dict, n_support, n_classes, n_query, n_unlabeled=0, num_workers=1, tokenizer=None, max_length=128,
+                          static_length=False):
+    dataset = EpisodeDataset(
+        data_dict=data_dict,
+        n_support=n_support,
+        n_classes=n_classes,
+        n_query=n_query,
+        n_unlabeled=n_unlabeled,
+        tokenizer=tokenizer,
+        max_length=max_length,
+        static_length=static_length
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=1,
+        num_workers=num_workers,
+        collate_fn=first_item_collate,
+        worker_init_fn=episode_worker_init_fn,
+        pin_memory=tokenizer is not None and torch.cuda.is_available()
+    )
+
+
 def create_ARSC_train_episode(n_support: int = 5, n_query: int = 5, n_unlabeled=0):
     labels = sorted(
         set([line.strip() for line in open("data/ARSC-Yu/raw/workspace.filtered.list", "r").readlines()])
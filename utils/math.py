@@ -15,6 +15,16 @@ def euclidean_dist(x, y):
     return torch.pow(x - y, 2).sum(2)
 
 
+def matmul_cdist(x, y):
+    # x: N x D
+    # y: M x D
+    # ||x||^2 + ||y||^2 - 2.x.y computed with a single GEMM, so no (N, M, D) intermediate is materialized
+    x_norm = x.pow(2).sum(-1, keepdim=True)
+    y_norm = y.pow(2).sum(-1, keepdim=True)
+    squared_distances = torch.addmm(y_norm.t(), x, y.t(), alpha=-2).add_(x_norm)
+    return squared_distances.clamp_min_(1e-30).sqrt_()
+
+
 def cosine_similarity(x, y):
     x = (x / x.norm(dim=1).view(-1, 1))
     y = (y / y.norm(dim=1).view(-1, 1))